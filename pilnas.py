@@ -22,40 +22,122 @@ except ImportError:
  
 import time
 import subprocess
-import cv2
 import numpy as np
 from datetime import datetime
 import threading
+import queue
 import requests   # HTTP client to send data
  
+try:
+    from picamera2 import Picamera2   # persistent in-memory camera stream
+except ImportError:
+    Picamera2 = None                  # fall back to one rpicam-still per capture
+ 
+try:
+    import pigpio                     # hardware-timed GPIO through the pigpiod daemon
+except ImportError:
+    pigpio = None                     # fall back to polling with RPi.GPIO
+ 
 # -----------------------------------------------------------------------------
 # NETWORK CONFIGURATION  (update host if needed)
 # -----------------------------------------------------------------------------
 HOST = "192.168.32.142"                  # address of computer running Node‑RED
 URL  = f"http://{HOST}:1880/feeder"
  
+# Keep-alive session: every post reuses the same TCP connection to Node‑RED
+SESSION = requests.Session()
+SESSION.mount("http://", requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=1))
+ 
+# Payloads waiting for the background sender (oldest first, new ones dropped when full)
+TELEMETRY_QUEUE = queue.Queue(maxsize=16)
+TELEMETRY_THREAD = None
+ 
+# OpenCV is slow to load, so AnimalColorDetector.__init__ imports it on first use
+cv2 = None
+ 
 # GPIO Configuration
 SERVO_PIN = 4
 TRIGGER_PIN = 17
 ECHO_PIN = 27
  
+# Camera configuration
+CAMERA_SIZE = (640, 480)
+FRAME_MAX_AGE = 1.0             # s - older grabbed frames are never used for detection
+ 
 # Detection parameters
 ANIMAL_DETECTION_DISTANCE = 50  # cm - distance to trigger detection
 COLOR_THRESHOLD = 10            # percent of colour pixels to trigger servo
+DETECTION_SIZE = (160, 120)     # frame is downscaled to this (w, h) before colour analysis
+STATUS_INTERVAL = 1.0           # s - minimum time between distance status refreshes
+OPENCV_THREADS = 2              # OpenCV worker threads (1-4 on a Pi; more over-subscribes the cores)
+ 
+ 
+def telemetry_worker():
+    """Post queued feeder data to the Node‑RED endpoint."""
+    while True:
+        payload = TELEMETRY_QUEUE.get()
+        try:
+            r = SESSION.post(URL, json=payload, timeout=5)
+            print(f"📡 Data sent to Node‑RED ({r.status_code}): {r.text.strip()}")
+        except Exception as e:
+            print(f"⚠️  Could not send data: {e}")
  
  
 def send_feeder_data(remaining_food, fed, time_until_next_feed):
-    """Send feeder data to the Node‑RED endpoint."""
+    """Queue feeder data for the Node‑RED endpoint without blocking."""
+    global TELEMETRY_THREAD
+    if TELEMETRY_THREAD is None:
+        TELEMETRY_THREAD = threading.Thread(target=telemetry_worker, daemon=True)
+        TELEMETRY_THREAD.start()
     payload = {
         "remaining_food": remaining_food,
         "fed": fed,
         "time_until_next_feed": time_until_next_feed
     }
     try:
-        r = requests.post(URL, json=payload, timeout=5)
-        print(f"📡 Data sent to Node‑RED ({r.status_code}): {r.text.strip()}")
-    except Exception as e:
-        print(f"⚠️  Could not send data: {e}")
+        TELEMETRY_QUEUE.put_nowait(payload)
+    except queue.Full:
+        print("⚠️  Node‑RED unreachable, telemetry queue full - dropping data")
+ 
+ 
+# =============================================================================
+#  BACKGROUND FRAME GRABBER
+# =============================================================================
+class FrameGrabber(threading.Thread):
+    """Continuously capture frames so the newest one is ready on demand."""
+    def __init__(self, picam2):
+        super().__init__(daemon=True)
+        self.picam2 = picam2
+        self.lock = threading.Lock()
+        self.frame = None
+        self.frame_time = 0
+        self.running = True
+ 
+    def run(self):
+        while self.running:
+            try:
+                frame = self.picam2.capture_array()
+            except Exception:
+                # Never leave an old frame behind after a camera fault
+                with self.lock:
+                    self.frame = None
+                time.sleep(0.1)
+                continue
+            with self.lock:
+                self.frame = frame
+                self.frame_time = time.monotonic_ns()
+ 
+    def latest(self):
+        """Return the newest frame, or None if it is older than FRAME_MAX_AGE."""
+        with self.lock:
+            if self.frame is None:
+                return None
+            if time.monotonic_ns() - self.frame_time > FRAME_MAX_AGE * 1_000_000_000:
+                return None
+            return self.frame
+ 
+    def stop(self):
+        self.running = False
  
  
 # =============================================================================
@@ -76,18 +158,32 @@ class AnimalColorDetector:
         self.rotation_time = 1.0
         self.live_view_active = False
         self.servo_pwm = None
+        self._small_buf = np.empty(DETECTION_SIZE[::-1] + (3,), dtype=np.uint8)
+        self._hsv_buf = np.empty(DETECTION_SIZE[::-1] + (3,), dtype=np.uint8)
+        self._mask_buf = np.empty(DETECTION_SIZE[::-1], dtype=np.uint8)
+        self._combined_buf = np.empty(DETECTION_SIZE[::-1], dtype=np.uint8)
+        self._total_pixels = self._combined_buf.size
+        self._threshold_pixels = int(self._total_pixels * COLOR_THRESHOLD / 100)
         try:
-            self.servo_pwm = GPIO.PWM(SERVO_PIN, 50)
-            self.servo_pwm.start(0)
+            if not self.pi:
+                self.servo_pwm = GPIO.PWM(SERVO_PIN, 50)
+                self.servo_pwm.start(0)
             self.stop_servo()
             print("📐 Servo initialized.")
         except Exception as e:
             print(f"⚠️ Servo initialization warning: {e}")
  
+        # OpenCV is only imported here, after the colour and cycle prompts
+        global cv2
+        import cv2
+        cv2.setUseOptimized(True)
+        cv2.setNumThreads(OPENCV_THREADS)
+        self.setup_camera()
         self.setup_color_ranges()
         self.image_dir = "captured_images"
-        if not os.path.exists(self.image_dir):
-            os.makedirs(self.image_dir)
+        os.makedirs(self.image_dir, exist_ok=True)
+        self.write_q = queue.Queue(maxsize=32)
+        threading.Thread(target=self.jpeg_writer, daemon=True).start()
         print(f"✅ System ready for {self.target_color.upper()} detection!")
  
     # -------------------------------------------------------------------------
@@ -103,6 +199,55 @@ class AnimalColorDetector:
         GPIO.setup(TRIGGER_PIN, GPIO.OUT, initial=GPIO.LOW)
         GPIO.setup(ECHO_PIN, GPIO.IN, pull_up_down=GPIO.PUD_DOWN)
         GPIO.setup(SERVO_PIN, GPIO.OUT)
+        self.setup_pigpio()
+ 
+    # -------------------------------------------------------------------------
+    def setup_pigpio(self):
+        self.pi = None
+        self.echo_cb = None
+        self.echo_rise = None
+        self.echo_ticks = 0
+        self.echo_done = threading.Event()
+        if pigpio is None:
+            return
+        try:
+            pi = pigpio.pi()
+            if not pi.connected:
+                print("⚠️ pigpiod not running, using polled distance readings.")
+                return
+            self.pi = pi
+            self.echo_cb = pi.callback(ECHO_PIN, pigpio.EITHER_EDGE, self.on_echo_edge)
+        except Exception as e:
+            self.pi = None
+            print(f"⚠️ pigpio initialization warning: {e}")
+ 
+    # -------------------------------------------------------------------------
+    def on_echo_edge(self, gpio, level, tick):
+        # Runs in pigpio's callback thread; ticks are microsecond timestamps
+        if level == 1:
+            self.echo_rise = tick
+        elif level == 0 and self.echo_rise is not None:
+            self.echo_ticks = pigpio.tickDiff(self.echo_rise, tick)
+            self.echo_done.set()
+ 
+    # -------------------------------------------------------------------------
+    def setup_camera(self):
+        self.picam2 = None
+        self.grabber = None
+        if Picamera2 is None:
+            print("⚠️ picamera2 not available, using rpicam-still captures.")
+            return
+        try:
+            self.picam2 = Picamera2()
+            self.picam2.configure(self.picam2.create_video_configuration(
+                main={"size": CAMERA_SIZE, "format": "RGB888"}))
+            self.picam2.start()
+            self.grabber = FrameGrabber(self.picam2)
+            self.grabber.start()
+            print("📷 Camera stream started.")
+        except Exception as e:
+            self.picam2 = None
+            print(f"⚠️ Camera stream warning, using rpicam-still: {e}")
  
     # -------------------------------------------------------------------------
     def setup_color_ranges(self):
@@ -119,12 +264,24 @@ class AnimalColorDetector:
             'blue':   [[(100, 50, 50), (130, 255, 255)]],
             'tan':    [[(15, 20, 50), (25, 100, 200)]]
         }
-        self.color_ranges = self.all_color_ranges.get(self.target_color,
-                                                      self.all_color_ranges['brown'])
+        ranges = self.all_color_ranges.get(self.target_color,
+                                           self.all_color_ranges['brown'])
+        self.color_ranges = [(np.asarray(lower, np.uint8), np.asarray(upper, np.uint8))
+                             for lower, upper in ranges]
+ 
+    # -------------------------------------------------------------------------
+    def set_servo(self, duty):
+        if self.pi:
+            # duty cycle % of the 20 ms servo period -> pulse width in µs
+            self.pi.set_servo_pulsewidth(SERVO_PIN, int(duty * 200))
+        elif self.servo_pwm:
+            self.servo_pwm.ChangeDutyCycle(duty)
  
     # -------------------------------------------------------------------------
     def stop_servo(self):
-        if self.servo_pwm:
+        if self.pi:
+            self.pi.set_servo_pulsewidth(SERVO_PIN, 0)
+        elif self.servo_pwm:
             self.servo_pwm.ChangeDutyCycle(self.servo_stop)
             time.sleep(0.1)
             self.servo_pwm.ChangeDutyCycle(0)
@@ -132,12 +289,12 @@ class AnimalColorDetector:
     # -------------------------------------------------------------------------
     def dispense_food(self):
         print("🍽️ Dispensing food...")
-        if self.servo_pwm:
-            self.servo_pwm.ChangeDutyCycle(self.servo_open)
+        if self.pi or self.servo_pwm:
+            self.set_servo(self.servo_open)
             time.sleep(self.rotation_time)
             self.stop_servo()
             time.sleep(0.2)
-            self.servo_pwm.ChangeDutyCycle(self.servo_close)
+            self.set_servo(self.servo_close)
             time.sleep(self.rotation_time)
             self.stop_servo()
         print("✅ Dispensing complete. Feeder returned to start.")
@@ -153,48 +310,91 @@ class AnimalColorDetector:
             print(f"⚠️ Failed to send feeder data: {e}")
  
     # -------------------------------------------------------------------------
-    def capture_image_rpicam(self):
-        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-        filename = os.path.join(self.image_dir,
-                                f"detection_{self.target_color}_{timestamp}.jpg")
-        cmd = ['rpicam-still', '-o', filename, '-t', '1',
-               '--width', '640', '--height', '480', '--immediate', '-n']
+    def grab_frame(self):
+        if self.picam2:
+            try:
+                # RGB888 frames are laid out B, G, R - the order cv2 expects.
+                # A missing or stale frame means the camera has stalled: report
+                # a failed capture rather than judging an old image.
+                return self.grabber.latest()
+            except Exception:
+                return None
+        # No stream: have rpicam-still write the JPEG to stdout instead of a file
+        cmd = ['rpicam-still', '-o', '-', '-t', '1',
+               '--width', str(CAMERA_SIZE[0]), '--height', str(CAMERA_SIZE[1]),
+               '--immediate', '-n']
         try:
             result = subprocess.run(cmd, capture_output=True, timeout=5)
             if result.returncode == 0:
-                image = cv2.imread(filename)
-                if image is not None:
-                    return cv2.cvtColor(image, cv2.COLOR_BGR2RGB), filename
+                data = np.frombuffer(result.stdout, dtype=np.uint8)
+                return cv2.imdecode(data, cv2.IMREAD_COLOR)
         except Exception:
             pass
-        return None, None
+        return None
+ 
+    # -------------------------------------------------------------------------
+    def save_jpeg(self, image, filename):
+        try:
+            ok, jpeg = cv2.imencode(".jpg", image)
+            if ok:
+                # The SD-card write happens on the jpeg_writer thread
+                self.write_q.put_nowait((filename, jpeg))
+                return True
+        except Exception:
+            pass
+        return False
+ 
+    # -------------------------------------------------------------------------
+    def jpeg_writer(self):
+        while True:
+            filename, jpeg = self.write_q.get()
+            try:
+                with open(filename, "wb") as f:
+                    f.write(jpeg)
+            except Exception as e:
+                print(f"⚠️ Could not save {filename}: {e}")
+            finally:
+                self.write_q.task_done()
+ 
+    # -------------------------------------------------------------------------
+    def image_filename(self):
+        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+        return os.path.join(self.image_dir,
+                            f"detection_{self.target_color}_{timestamp}.jpg")
  
     # -------------------------------------------------------------------------
     def detect_target_color(self, image):
-        hsv = cv2.cvtColor(image, cv2.COLOR_RGB2HSV)
-        combined_mask = np.zeros(hsv.shape[:2], dtype=np.uint8)
-        for lower, upper in self.color_ranges:
-            mask = cv2.inRange(hsv, np.array(lower), np.array(upper))
-            combined_mask = cv2.bitwise_or(combined_mask, mask)
-        kernel = np.ones((5, 5), np.uint8)
-        combined_mask = cv2.morphologyEx(combined_mask, cv2.MORPH_CLOSE, kernel)
-        combined_mask = cv2.morphologyEx(combined_mask, cv2.MORPH_OPEN, kernel)
+        small = cv2.resize(image, DETECTION_SIZE, dst=self._small_buf,
+                           interpolation=cv2.INTER_AREA)
+        hsv = cv2.cvtColor(small, cv2.COLOR_BGR2HSV, dst=self._hsv_buf)
+        combined_mask = self._combined_buf
+        # The first range writes the mask directly; no zero-fill or OR pass needed
+        lower, upper = self.color_ranges[0]
+        cv2.inRange(hsv, lower, upper, dst=combined_mask)
         color_pixels = cv2.countNonZero(combined_mask)
-        total_pixels = image.shape[0] * image.shape[1]
-        return (color_pixels / total_pixels) * 100
+        for lower, upper in self.color_ranges[1:]:
+            # Later ranges can only add pixels, so stop once the threshold is met
+            if color_pixels >= self._threshold_pixels:
+                break
+            cv2.inRange(hsv, lower, upper, dst=self._mask_buf)
+            combined_mask |= self._mask_buf
+            color_pixels = cv2.countNonZero(combined_mask)
+        return (color_pixels / self._total_pixels) * 100
  
     # -------------------------------------------------------------------------
     def process_detection(self):
         print("\n📸 Capturing image...")
-        image, filename = self.capture_image_rpicam()
+        image = self.grab_frame()
         if image is None:
             print("❌ Failed to capture image")
             return False
-        print(f"   Image saved: {filename}")
         color_percentage = self.detect_target_color(image)
         print(f"📊 {self.target_color.capitalize()} pixels: {color_percentage:.2f}%")
         if color_percentage >= COLOR_THRESHOLD:
             print(f"✅ {self.target_color.upper()} ANIMAL DETECTED! 🚨")
+            filename = self.image_filename()
+            if self.save_jpeg(image, filename):
+                print(f"   Image saved: {filename}")
             self.dispense_food()
             return True
         else:
@@ -203,22 +403,39 @@ class AnimalColorDetector:
  
     # -------------------------------------------------------------------------
     def get_distance(self):
+        if self.pi:
+            return self.get_distance_pigpio()
         try:
-            GPIO.output(TRIGGER_PIN, False)
-            time.sleep(0.1)
+            # TRIGGER_PIN idles low (set in setup_gpio and after every pulse)
             GPIO.output(TRIGGER_PIN, True)
             time.sleep(0.00001)
             GPIO.output(TRIGGER_PIN, False)
-            pulse_start = time.time()
-            timeout = time.time() + 0.5
-            while GPIO.input(ECHO_PIN) == 0 and time.time() < timeout:
-                pulse_start = time.time()
-            pulse_end = time.time()
-            timeout = time.time() + 0.5
-            while GPIO.input(ECHO_PIN) == 1 and time.time() < timeout:
-                pulse_end = time.time()
-            duration = pulse_end - pulse_start
-            distance = duration * 17150
+            clock = time.monotonic_ns
+            read = GPIO.input
+            # 30 ms covers the longest valid echo (400 cm is ~23 ms)
+            pulse_start = clock()
+            timeout = pulse_start + 30_000_000
+            while read(ECHO_PIN) == 0 and pulse_start < timeout:
+                pulse_start = clock()
+            pulse_end = clock()
+            timeout = pulse_end + 30_000_000
+            while read(ECHO_PIN) == 1 and pulse_end < timeout:
+                pulse_end = clock()
+            duration_ns = pulse_end - pulse_start
+            distance = duration_ns * 17150 / 1_000_000_000
+            return round(distance, 2) if 2 < distance < 400 else None
+        except Exception:
+            return None
+ 
+    # -------------------------------------------------------------------------
+    def get_distance_pigpio(self):
+        try:
+            self.echo_rise = None
+            self.echo_done.clear()
+            self.pi.gpio_trigger(TRIGGER_PIN, 10, 1)
+            if not self.echo_done.wait(0.05):
+                return None
+            distance = self.echo_ticks * 0.01715
             return round(distance, 2) if 2 < distance < 400 else None
         except Exception:
             return None
@@ -229,25 +446,41 @@ class AnimalColorDetector:
         print("🦊 AUTOMATIC MONITORING ACTIVE")
         print("=" * 50)
         print(f"⏰ Cycle time: {self.cycle_time}s\nPress Ctrl+C to stop\n")
-        last_detection_time = 0
+        # Monotonic integer nanoseconds: immune to NTP/wall-clock jumps
+        cycle_ns = self.cycle_time * 1_000_000_000
+        status_ns = int(STATUS_INTERVAL * 1_000_000_000)
+        last_detection_time = None
+        last_state = None
+        last_status_time = 0
         while True:
             try:
                 distance = self.get_distance()
+                current_time = time.monotonic_ns()
                 if distance and distance < ANIMAL_DETECTION_DISTANCE:
-                    current_time = time.time()
-                    if current_time - last_detection_time > self.cycle_time:
+                    state = "cooldown"
+                    if (last_detection_time is None
+                            or current_time - last_detection_time > cycle_ns):
+                        state = None
                         print(f"\n🚨 ANIMAL DETECTED at {distance:.2f} cm!")
                         if self.process_detection():
                             last_detection_time = current_time
                             print(f"\n⏳ Next detection in {self.cycle_time}s...")
-                    else:
-                        remaining = int(self.cycle_time - (current_time - last_detection_time))
-                        print(f"📏 Distance: {distance:.2f}cm – Cooldown: {remaining}s", end="\r")
+                elif distance:
+                    state = "clear"
                 else:
-                    if distance:
+                    state = "no reading"
+                # Refresh the status line on state changes, otherwise once per STATUS_INTERVAL
+                if state and (state != last_state
+                              or current_time - last_status_time >= status_ns):
+                    if state == "cooldown":
+                        remaining = (cycle_ns - (current_time - last_detection_time)) // 1_000_000_000
+                        print(f"📏 Distance: {distance:.2f}cm – Cooldown: {remaining}s", end="\r")
+                    elif state == "clear":
                         print(f"📏 Distance: {distance:.2f}cm – Clear        ", end="\r")
                     else:
                         print("📏 Distance: No reading        ", end="\r")
+                    last_status_time = current_time
+                last_state = state
                 time.sleep(0.5)
             except KeyboardInterrupt:
                 print("\nReturning to menu...")
@@ -260,11 +493,25 @@ class AnimalColorDetector:
     def cleanup(self):
         print("\n🧹 Cleaning up...")
         try:
+            self.write_q.join()      # let queued photos reach the SD card
             if self.servo_pwm:
                 self.stop_servo()
                 time.sleep(0.5)
                 self.servo_pwm.stop()
                 self.servo_pwm = None
+            if self.grabber:
+                self.grabber.stop()
+                self.grabber.join(timeout=1)
+                self.grabber = None
+            if self.picam2:
+                self.picam2.stop()
+                self.picam2.close()
+                self.picam2 = None
+            if self.pi:
+                self.stop_servo()
+                self.echo_cb.cancel()
+                self.pi.stop()
+                self.pi = None
             GPIO.cleanup()
         except Exception:
             pass
@@ -282,8 +529,10 @@ def get_color_choice():
     remembered = None
     if os.path.exists(filename):
         try:
-            with open(filename, "r") as f:
-                remembered = f.read().strip().lower()
+            # Stored as a single byte: the index into `colors`
+            with open(filename, "rb") as f:
+                idx = f.read(1)[0]
+            remembered = colors[idx] if idx < len(colors) else None
         except Exception:
             pass
  
@@ -311,8 +560,8 @@ def get_color_choice():
         print("❌ Invalid choice, try again.")
  
     try:
-        with open(filename, "w") as f:
-            f.write(selected)
+        with open(filename, "wb") as f:
+            f.write(bytes([colors.index(selected)]))
     except Exception as e:
         print(f"⚠️ Could not save color preference: {e}")
  